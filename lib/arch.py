@@ -348,7 +348,7 @@ class DiscriminatorStack(nn.Module):
         stacked = torch.cat((image, wv_out), dim=1)
         out = self.conv(stacked)
         if self.minibatch_discrimination:
-            out = out.view(-1, self.out_channels * 2 * 2)
+            out = out.reshape(-1, self.out_channels * 2 * 2)
             out = torch.cat((out, self.mbd(out)), dim=1)
             # return self.fc_last(out)
         return out
@@ -412,7 +412,7 @@ class DiscriminatorDecider(nn.Module):
     def forward(self, image):
         out = self.conv(image)
         if self.minibatch_discrimination:
-            out = out.view(-1, self.out_channels * 2 * 2)
+            out = out.reshape(-1, self.out_channels * 2 * 2)
             out = torch.cat((out, self.mbd(out)), dim=1)
         return out
 
@@ -481,7 +481,7 @@ class DiscriminatorDecider2(nn.Module):
     def forward(self, image):
         out = self.conv(image)
         if self.minibatch_discrimination:
-            out = out.view(-1, self.out_channels * 2 * 2)
+            out = out.reshape(-1, self.out_channels * 2 * 2)
             out = torch.cat((out, self.mbd(out)), dim=1)
         return out
 
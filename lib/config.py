@@ -112,6 +112,21 @@ G_refiner2_loss,D_decider2_loss,D_rr_acc,D_rf_acc,D_fr_acc,D_decider_rr_acc,D_de
         # self.DEVICE = torch.device('cpu')
         self.N_WORKERS = 8
         self.N_GPUS = 1
+        self.USE_AMP = True   ## bfloat16 autocast on cuda (no grad scaling needed)
+        self.COMPILE = True   ## torch.compile the generators on cuda (critics stay eager)
+        self.COMPILE_MODE = 'reduce-overhead'   ## One of 'default', 'reduce-overhead', 'max-autotune'
+
+        ## Distributed (set by torchrun, e.g. `torchrun --nproc_per_node=4 train.py`)
+        self.WORLD_SIZE = int(os.environ.get('WORLD_SIZE', 1))
+        self.RANK = int(os.environ.get('RANK', 0))
+        self.LOCAL_RANK = int(os.environ.get('LOCAL_RANK', 0))
+        self.DISTRIBUTED = self.WORLD_SIZE > 1
+        self.DIST_BACKEND = 'nccl'
+        assert self.BATCH_SIZE >= self.WORLD_SIZE and self.BATCH_SIZE % self.WORLD_SIZE == 0,\
+            'BATCH_SIZE ({}) should be a multiple of WORLD_SIZE ({})'.format(self.BATCH_SIZE, self.WORLD_SIZE)
+        self.RANK_BATCH_SIZE = self.BATCH_SIZE // self.WORLD_SIZE   ## BATCH_SIZE is split over processes
+        if self.DISTRIBUTED:
+            self.DEVICE = torch.device('cuda', self.LOCAL_RANK)
 
         ## Logging
         # self.N_PRINT_BATCH = 50
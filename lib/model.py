@@ -1,4 +1,6 @@
 from abc import ABC, abstractmethod
+import contextlib
+import inspect
 import os
 import shutil
 import time
@@ -6,12 +8,14 @@ import time
 import numpy as np
 from PIL import Image
 import torch
+import torch.distributed as dist
 import torchvision
-from torchvision.utils import make_grid
+from torch.nn.parallel import DistributedDataParallel
+from torchvision.utils import make_grid, save_image
 
 from lib.arch import GeneratorResNet, DiscriminatorStack, GeneratorRefinerUNet, DiscriminatorDecider, GeneratorRefinerUNet2, DiscriminatorDecider2
 from lib.utils import (GANLoss, get_single_gradient_penalty, get_paired_gradient_penalty,
-                    get_uuid, words2image, ImageUtilities)
+                    get_uuid, init_distributed, words2image, ImageUtilities)
 
 class BaseModel(ABC):
 
@@ -31,29 +35,19 @@ class BaseModel(ABC):
         weight_decay = config.WEIGHT_DECAY
         self.lambda_l1 = config.LAMBDA_L1
 
-        self.state_dict = {
-                          'g' : None,
-                          'g_optim' : None,
-                          'g_lr_scheduler' : None,
-                          'd' : None,
-                          'd_optim' : None,
-                          'd_lr_scheduler' : None,
-                          'epoch' : None
-                          }
         self.epoch = 0
         self.loss_G = None
         self.loss_D = None
         self.model_dir = None
         self.train_log_file = None
         self.val_log_file = None
+        self.train_log_fh = None
+        self.val_log_fh = None
 
     @abstractmethod
     def load_state_dict(self, model_file):
         pass
     @abstractmethod
-    def set_state_dict(self):
-        pass
-    @abstractmethod
     def save_model_dict(self, epoch, iteration, loss_g, loss_d):
         pass
     @abstractmethod
@@ -63,10 +57,13 @@ class BaseModel(ABC):
     def save_logs(self, log_tuple):
         pass
     @abstractmethod
+    def close_logs(self):
+        pass
+    @abstractmethod
     def set_requires_grad(self, net, requires_grad=False):
         pass
     @abstractmethod
-    def get_losses(self):
+    def get_losses(self, as_tensor=False):
         pass
     @abstractmethod
     def get_D_accuracy(self):
@@ -93,7 +90,14 @@ class GANModel(BaseModel):
         self.model_name = config.MODEL_NAME
         self.log_header = config.LOG_HEADER
 
-        self.batch_size = config.BATCH_SIZE
+        ## Distributed
+        self.distributed = config.DISTRIBUTED and self.mode in ['train']
+        self.local_rank = config.LOCAL_RANK
+        self.is_main_process = config.RANK == 0
+        if self.distributed:
+            init_distributed(config)
+
+        self.batch_size = config.RANK_BATCH_SIZE if self.distributed else config.BATCH_SIZE
         self.gan_loss1 = config.GAN_LOSS1
         self.gan_loss2 = config.GAN_LOSS2
 
@@ -117,20 +121,32 @@ class GANModel(BaseModel):
         self.inv_normalize = config.NORMALIZE
         self.prob_flip_labels = config.PROB_FLIP_LABELS
         self.min_similarity_prob = config.MIN_WV_SIMILARITY_PROB
+        self.use_amp = config.USE_AMP and self.device.type == 'cuda' and hasattr(torch, 'autocast')   ## torch >= 1.10
+        self.set_to_none = 'set_to_none' in inspect.signature(torch.optim.Optimizer.zero_grad).parameters   ## torch >= 1.7
+        self.use_compile = config.COMPILE and self.device.type == 'cuda' and hasattr(torch, 'compile')   ## torch >= 2.0
 
         self.inverse_normalizer = ImageUtilities.image_inverse_normalizer(self.config.MEAN, self.config.STD)
-        self.image_resizer = ImageUtilities.image_resizer(self.config.IMAGE_HEIGHT, self.config.IMAGE_WIDTH, interpolation=Image.NEAREST)
-
-        ## Init G
-        self.G = GeneratorResNet(config).to(self.device)
-        self.G_refiner = GeneratorRefinerUNet(config).to(self.device)
-        self.G_refiner2 = GeneratorRefinerUNet2(config).to(self.device)
+        self.mean_tensor = torch.tensor(self.config.MEAN, device=self.device).view(1, -1, 1, 1)
+        self.std_tensor = torch.tensor(self.config.STD, device=self.device).view(1, -1, 1, 1)
+        self.loss_placeholder = torch.tensor(-1.0, device=self.device)
+
+        ## Input shapes are fixed, let cudnn pick the fastest conv algorithms
+        torch.backends.cudnn.benchmark = True
+        if hasattr(torch.backends.cuda, 'matmul'):   ## TF32 switches, torch >= 1.7
+            torch.backends.cuda.matmul.allow_tf32 = True
+            torch.backends.cudnn.allow_tf32 = True
+        self.channels_last = hasattr(torch, 'channels_last')   ## torch >= 1.5
+
+        ## Init G (channels_last for NHWC tensor core convs)
+        self.G = self.to_device(GeneratorResNet(config))
+        self.G_refiner = self.to_device(GeneratorRefinerUNet(config))
+        self.G_refiner2 = self.to_device(GeneratorRefinerUNet2(config))
 
         ## Init D, optimizers, schedulers
         if self.mode in ['train']:
-            self.D = DiscriminatorStack(config).to(self.device)
-            self.D_decider = DiscriminatorDecider(config).to(self.device)
-            self.D_decider2 = DiscriminatorDecider2(config).to(self.device)
+            self.D = self.to_device(DiscriminatorStack(config))
+            self.D_decider = self.to_device(DiscriminatorDecider(config))
+            self.D_decider2 = self.to_device(DiscriminatorDecider2(config))
             self.G_criterionGAN = GANLoss(self.gan_loss1, self.device, accuracy=False).to(self.device)
             self.D_criterionGAN = GANLoss(self.gan_loss1, self.device, accuracy=True).to(self.device)
             self.G_refiner_criterionGAN = GANLoss(self.gan_loss2, self.device, accuracy=True).to(self.device)
@@ -208,9 +224,26 @@ class GANModel(BaseModel):
                                                                                      patience=lr_drop_patience,
                                                                                      min_lr=lr_min_val)
 
-        ## Parallelize over gpus
-        if self.device == torch.device('cuda') and torch.cuda.device_count() > 1:
-        # if torch.cuda.device_count() > 1:
+        ## Init weights (before wrapping, DDP broadcasts rank 0 weights to other processes)
+        if not model_file:
+            self.init_weights(self.G, weight_init, init_gain=init_gain)
+            self.init_weights(self.G_refiner, weight_init, init_gain=init_gain)
+            self.init_weights(self.G_refiner2, weight_init, init_gain=init_gain)
+            self.init_weights(self.D, weight_init, init_gain=init_gain)
+            self.init_weights(self.D_decider, weight_init, init_gain=init_gain)
+            self.init_weights(self.D_decider2, weight_init, init_gain=init_gain)
+
+        ## Parallelize over gpus, one process per gpu
+        if self.distributed:
+            self.G = self.distribute(self.G)
+            self.G_refiner = self.distribute(self.G_refiner)
+            self.G_refiner2 = self.distribute(self.G_refiner2)
+            ## SyncBatchNorm has no double backward, critics keep local BN under a gradient penalty
+            self.D = self.distribute(self.D, sync_bn=self.gan_loss1 != 'wgangp')
+            self.D_decider = self.distribute(self.D_decider, sync_bn=self.gan_loss2 != 'wgangp')
+            self.D_decider2 = self.distribute(self.D_decider2, sync_bn=self.gan_loss2 != 'wgangp')
+        ## Single process (e.g. test), keeps 'module.' prefixed checkpoints loadable
+        elif self.device == torch.device('cuda') and torch.cuda.device_count() > 1:
             self.G = torch.nn.DataParallel(self.G)
             self.G_refiner = torch.nn.DataParallel(self.G_refiner)
             self.G_refiner2 = torch.nn.DataParallel(self.G_refiner2)
@@ -219,27 +252,15 @@ class GANModel(BaseModel):
                 self.D_decider = torch.nn.DataParallel(self.D_decider)
                 self.D_decider2 = torch.nn.DataParallel(self.D_decider2)
 
+        ## Compile (after wrapping) for kernel fusion and CUDA graphs
+        if self.use_compile:
+            self.G = self.compile(self.G)
+            self.G_refiner = self.compile(self.G_refiner)
+            self.G_refiner2 = self.compile(self.G_refiner2)
+            ## Critics stay eager: they run twice (rr, fr) before one backward, and spectral_norm's
+            ## in-place weight_u update between the calls breaks the compiled backward
+
         ## Init things (these will get values later) 
-        self.state_dict = {
-                          'g' : None,
-                          'g_optim' : None,
-                          'g_lr_scheduler' : None,
-                          'd' : None,
-                          'd_optim' : None,
-                          'd_lr_scheduler' : None,
-                          'g_refiner' : None,
-                          'g_refiner_optim' : None,
-                          'g_refiner_lr_scheduler' : None,
-                          'd_decider' : None,
-                          'd_decider_optim' : None,
-                          'd_decider_lr_scheduler' : None,
-                          'g_refiner2' : None,
-                          'g_refiner2_optim' : None,
-                          'g_refiner2_lr_scheduler' : None,
-                          'd_decider2' : None,
-                          'd_decider2_optim' : None,
-                          'd_decider2_lr_scheduler' : None,
-                          }
         self.epoch = 1
         self.loss_G = None
         self.loss_D = None
@@ -258,60 +279,61 @@ class GANModel(BaseModel):
         self.accuracy_D_decider_fr = 0.0
         self.accuracy_D_decider2_rr = 0.0
         self.accuracy_D_decider2_fr = 0.0
+        self.word_matrix = None
         self.model_dir = None
         self.train_log_file = None
         self.val_log_file = None
+        self.train_log_fh = None
+        self.val_log_fh = None
 
         if model_file:
             self.load_state_dict(model_file)
-            self.set_model_dir(model_file)
-            print("{} loaded.".format(self.model_dir))
+            if self.is_main_process:
+                self.set_model_dir(model_file)
+                print("{} loaded.".format(self.model_dir))
             if self.mode == 'test':
                 self.set_output_dir()
         else:
-            ## Init weights
-            self.init_weights(self.G, weight_init, init_gain=init_gain)
-            self.init_weights(self.G_refiner, weight_init, init_gain=init_gain)
-            self.init_weights(self.G_refiner2, weight_init, init_gain=init_gain)
-            self.init_weights(self.D, weight_init, init_gain=init_gain)
-            self.init_weights(self.D_decider, weight_init, init_gain=init_gain)
-            self.init_weights(self.D_decider2, weight_init, init_gain=init_gain)
-
-            self.set_state_dict()
-            self.set_model_dir()
-            print("{} created.".format(self.model_dir))
+            if self.is_main_process:
+                self.set_model_dir()
+                print("{} created.".format(self.model_dir))
         time.sleep(1.0)
 
-        if self.mode in ['train']:
-            G_lr = self.G_optimizer.param_groups[0]['lr']
-            D_lr = self.D_optimizer.param_groups[0]['lr']
-            G_refiner_lr = self.G_refiner_optimizer.param_groups[0]['lr']
-            D_decider_lr = self.D_decider_optimizer.param_groups[0]['lr']
-            G_refiner2_lr = self.G_refiner2_optimizer.param_groups[0]['lr']
-            D_decider2_lr = self.D_decider2_optimizer.param_groups[0]['lr']
-
-        print("# parameters of G: {:2E}".format(sum(p.numel() for p in self.G.parameters())))
-        print("# parameters of G refiner: {:2E}".format(sum(p.numel() for p in self.G_refiner.parameters())))
-        print("# parameters of G refiner2: {:2E}".format(sum(p.numel() for p in self.G_refiner2.parameters())))
-        if self.mode in ['train']:
-            print("# parameters of D: {:2E}".format(sum(p.numel() for p in self.D.parameters())))
-            print("# parameters of D decider: {:2E}".format(sum(p.numel() for p in self.D_decider.parameters())))
-            print("# parameters of D decider2: {:2E}".format(sum(p.numel() for p in self.D_decider2.parameters())))
-        print("Device:", self.device)
+        ## Print diagnostics from one process only
+        if self.is_main_process:
+            if self.mode in ['train']:
+                G_lr = self.G_optimizer.param_groups[0]['lr']
+                D_lr = self.D_optimizer.param_groups[0]['lr']
+                G_refiner_lr = self.G_refiner_optimizer.param_groups[0]['lr']
+                D_decider_lr = self.D_decider_optimizer.param_groups[0]['lr']
+                G_refiner2_lr = self.G_refiner2_optimizer.param_groups[0]['lr']
+                D_decider2_lr = self.D_decider2_optimizer.param_groups[0]['lr']
+
+            print("# parameters of G: {:2E}".format(self.count_parameters(self.G)))
+            print("# parameters of G refiner: {:2E}".format(self.count_parameters(self.G_refiner)))
+            print("# parameters of G refiner2: {:2E}".format(self.count_parameters(self.G_refiner2)))
+            if self.mode in ['train']:
+                print("# parameters of D: {:2E}".format(self.count_parameters(self.D)))
+                print("# parameters of D decider: {:2E}".format(self.count_parameters(self.D_decider)))
+                print("# parameters of D decider2: {:2E}".format(self.count_parameters(self.D_decider2)))
+            print("Device:", self.device)
 
-        if self.mode in ['train']:
-            print("Parameters:")
-            print("\tBatch size:", self.batch_size)
-            print("\tGAN loss1:", self.gan_loss1)
-            print("\tGAN loss2:", self.gan_loss2)
-            # print("\tLearning rates (G, D): {:.4f}, {:.4f}".format(G_lr, D_lr))
-            print("\tLearning rates (G, D, G_refiner, D_decider, G_refiner2, D_decider2): \
+            if self.mode in ['train']:
+                print("Parameters:")
+                print("\tBatch size:", self.batch_size)
+                print("\tGAN loss1:", self.gan_loss1)
+                print("\tGAN loss2:", self.gan_loss2)
+                # print("\tLearning rates (G, D): {:.4f}, {:.4f}".format(G_lr, D_lr))
+                print("\tLearning rates (G, D, G_refiner, D_decider, G_refiner2, D_decider2): \
 {:.2E}, {:.2E}, {:.2E}, {:.2E}, {:.2E}, {:.2E}".format(G_lr, D_lr, G_refiner_lr, D_decider_lr, G_refiner2_lr, D_decider2_lr))
-            print("\tDropout rates (G, D): {:.2f}, {:.2f}".format(config.G_DROPOUT, config.D_DROPOUT))
-            print("\tAdam optimizer beta:", beta)
-            print("\tWeight decay:", weight_decay)
-            print("\tWeight initialization:", weight_init)
-            print("\tGenerator lambda weight:", self.lambda_l1)
+                print("\tDropout rates (G, D): {:.2f}, {:.2f}".format(config.G_DROPOUT, config.D_DROPOUT))
+                print("\tAdam optimizer beta:", beta)
+                print("\tWeight decay:", weight_decay)
+                print("\tWeight initialization:", weight_init)
+                print("\tGenerator lambda weight:", self.lambda_l1)
+
+    def count_parameters(self, net):
+        return sum(p.numel() for p in net.parameters())
 
     def init_weights(self, net, init_type, init_gain=0.02):
         def init_func(m):
@@ -335,6 +357,15 @@ class GANModel(BaseModel):
 
         net.apply(init_func)
 
+    def distribute(self, net, sync_bn=True):
+        if sync_bn:
+            net = torch.nn.SyncBatchNorm.convert_sync_batchnorm(net)
+        return DistributedDataParallel(net,
+                                       device_ids=[self.local_rank],
+                                       output_device=self.local_rank,
+                                       broadcast_buffers=False,
+                                       find_unused_parameters=False)
+
     def load_state_dict(self, model_file):
         ## Get epoch
         self.epoch = int(os.path.basename(model_file).split('_')[1]) + 1
@@ -347,15 +378,15 @@ class GANModel(BaseModel):
             state = torch.load(model_file, map_location=lambda storage, loc: storage)
             #state = torch.load(model_file, map_location=self.device)
         else:
-            state = torch.load(model_file)
+            state = torch.load(model_file, map_location=self.device)
 
-        self.G.load_state_dict(state['g'])
-        self.G_refiner.load_state_dict(state['g_refiner'])
-        self.G_refiner2.load_state_dict(state['g_refiner2'])
+        self.uncompiled(self.G).load_state_dict(state['g'])
+        self.uncompiled(self.G_refiner).load_state_dict(state['g_refiner'])
+        self.uncompiled(self.G_refiner2).load_state_dict(state['g_refiner2'])
         if self.mode in ['train']:
-            self.D.load_state_dict(state['d'])
-            self.D_decider.load_state_dict(state['d_decider'])
-            self.D_decider2.load_state_dict(state['d_decider2'])
+            self.uncompiled(self.D).load_state_dict(state['d'])
+            self.uncompiled(self.D_decider).load_state_dict(state['d_decider'])
+            self.uncompiled(self.D_decider2).load_state_dict(state['d_decider2'])
             self.G_optimizer.load_state_dict(state['g_optim'])
             self.D_optimizer.load_state_dict(state['d_optim'])
             self.G_refiner_optimizer.load_state_dict(state['g_refiner_optim'])
@@ -375,35 +406,31 @@ class GANModel(BaseModel):
             self.D_decider_optimizer.param_groups[0]['lr'] = self.config.D_DECIDER_LR
             self.G_refiner2_optimizer.param_groups[0]['lr'] = self.config.G_REFINER2_LR
             self.D_decider2_optimizer.param_groups[0]['lr'] = self.config.D_DECIDER2_LR
-        self.set_state_dict()
-
-    def set_state_dict(self):
-        self.state_dict['g'] = self.G.state_dict()
-        self.state_dict['g_refiner'] = self.G_refiner.state_dict()
-        self.state_dict['g_refiner2'] = self.G_refiner2.state_dict()
-        if self.mode in ['train']:
-            self.state_dict['d'] = self.D.state_dict()
-            self.state_dict['d_decider'] = self.D_decider.state_dict()
-            self.state_dict['d_decider2'] = self.D_decider2.state_dict()
-            self.state_dict['g_optim'] = self.G_optimizer.state_dict()
-            self.state_dict['d_optim'] = self.D_optimizer.state_dict()
-            self.state_dict['g_refiner_optim'] = self.G_refiner_optimizer.state_dict()
-            self.state_dict['d_decider_optim'] = self.D_decider_optimizer.state_dict()
-            self.state_dict['g_refiner2_optim'] = self.G_refiner2_optimizer.state_dict()
-            self.state_dict['d_decider2_optim'] = self.D_decider2_optimizer.state_dict()
-            self.state_dict['g_lr_scheduler'] = self.G_lr_scheduler.state_dict()
-            self.state_dict['d_lr_scheduler'] = self.D_lr_scheduler.state_dict()
-            self.state_dict['g_refiner_lr_scheduler'] = self.G_refiner_lr_scheduler.state_dict()
-            self.state_dict['d_decider_lr_scheduler'] = self.D_decider_lr_scheduler.state_dict()
-            self.state_dict['g_refiner2_lr_scheduler'] = self.G_refiner2_lr_scheduler.state_dict()
-            self.state_dict['d_decider2_lr_scheduler'] = self.D_decider2_lr_scheduler.state_dict()
 
     def save_model_dict(self, epoch, iteration, loss_g, loss_d, loss_g_refiner, loss_d_decider, loss_g_refiner2, loss_d_decider2):
         model_filename = "{}_{:04}_{:08}_{:.4f}_{:.4f}_{:.4f}_{:.4f}_{:.4f}_{:.4f}.pth".format(\
                          self.model_name, epoch, iteration, loss_g, loss_d, loss_g_refiner, loss_d_decider, loss_g_refiner2, loss_d_decider2)
         model_file = os.path.join(self.model_dir, model_filename)
-        self.set_state_dict()
-        torch.save(self.state_dict, model_file)
+        torch.save({
+                   'g' : self.uncompiled(self.G).state_dict(),
+                   'g_optim' : self.G_optimizer.state_dict(),
+                   'g_lr_scheduler' : self.G_lr_scheduler.state_dict(),
+                   'd' : self.uncompiled(self.D).state_dict(),
+                   'd_optim' : self.D_optimizer.state_dict(),
+                   'd_lr_scheduler' : self.D_lr_scheduler.state_dict(),
+                   'g_refiner' : self.uncompiled(self.G_refiner).state_dict(),
+                   'g_refiner_optim' : self.G_refiner_optimizer.state_dict(),
+                   'g_refiner_lr_scheduler' : self.G_refiner_lr_scheduler.state_dict(),
+                   'd_decider' : self.uncompiled(self.D_decider).state_dict(),
+                   'd_decider_optim' : self.D_decider_optimizer.state_dict(),
+                   'd_decider_lr_scheduler' : self.D_decider_lr_scheduler.state_dict(),
+                   'g_refiner2' : self.uncompiled(self.G_refiner2).state_dict(),
+                   'g_refiner2_optim' : self.G_refiner2_optimizer.state_dict(),
+                   'g_refiner2_lr_scheduler' : self.G_refiner2_lr_scheduler.state_dict(),
+                   'd_decider2' : self.uncompiled(self.D_decider2).state_dict(),
+                   'd_decider2_optim' : self.D_decider2_optimizer.state_dict(),
+                   'd_decider2_lr_scheduler' : self.D_decider2_lr_scheduler.state_dict(),
+                   }, model_file)
 
     def set_model_dir(self, model_file=None):
         if model_file:
@@ -415,12 +442,9 @@ class GANModel(BaseModel):
             os.makedirs(model_dir, exist_ok=True)
         self.model_dir = model_dir
 
-        ## Copy current lib/ tree
-        current_lib_dir = os.path.join(self.config.BASE_DIR, 'lib')
-        copy_lib_dir = os.path.join(model_dir, 'lib')
-        if os.path.isdir(copy_lib_dir):
-            shutil.rmtree(copy_lib_dir)
-        shutil.copytree(current_lib_dir, copy_lib_dir)
+        ## Snapshot current lib/ tree into a single zip, only for new models
+        if not model_file and self.mode in ['train']:
+            shutil.make_archive(os.path.join(model_dir, 'lib_snapshot'), 'zip', self.config.BASE_DIR, 'lib')
 
         ## Init log files
         train_log_filename = self.model_name + '_train_log.csv'
@@ -430,12 +454,13 @@ class GANModel(BaseModel):
         self.train_log_file = train_log_file
         self.val_log_file = val_log_file
 
-        ## Write headers if new model
-        if not model_file:
-            with open(train_log_file, 'w') as f:
-                f.write(self.log_header + '\n')
-            with open(val_log_file, 'w') as f:
-                f.write(self.log_header + '\n')
+        ## Keep log files open (line buffered) for training only, write headers if new model
+        if self.mode in ['train']:
+            self.train_log_fh = open(train_log_file, 'a', buffering=1)
+            self.val_log_fh = open(val_log_file, 'a', buffering=1)
+            if not model_file:
+                self.train_log_fh.write(self.log_header + '\n')
+                self.val_log_fh.write(self.log_header + '\n')
 
     def set_output_dir(self):
         self.output_dir = os.path.join(self.config.BASE_DIR, 'outputs', self.model_dirname)
@@ -444,7 +469,7 @@ class GANModel(BaseModel):
     def save_logs(self, log_tuple):
         phase, epoch, iteration, loss_g, loss_d, loss_g_refiner, loss_d_decider, loss_g_refiner2, loss_d_decider2,\
             acc_rr, acc_rf, acc_fr, acc_decider_rr, acc_decider_fr, acc_decider2_rr, acc_decider2_fr = log_tuple
-        log_file = self.train_log_file if phase == 'train' else self.val_log_file
+        log_fh = self.train_log_fh if phase == 'train' else self.val_log_fh
         log_row_str = '{},{},{:.4f},{:.4f},{:.4f},{:.4f},{:.4f},{:.4f},{:.4f},{:.4f},{:.4f},{:.4f},{:.4f},{:.4f},{:.4f}\n'.format(
                                                                                                                                  epoch,
                                                                                                                                  iteration,
@@ -461,269 +486,252 @@ class GANModel(BaseModel):
                                                                                                                                  acc_decider_fr,
                                                                                                                                  acc_decider2_rr,
                                                                                                                                  acc_decider2_fr)
-        with open(log_file, 'a') as f:
-            f.write(log_row_str)
+        log_fh.write(log_row_str)
+
+    def close_logs(self):
+        for log_fh in [self.train_log_fh, self.val_log_fh]:
+            if log_fh is not None:
+                log_fh.close()
+        self.train_log_fh = None
+        self.val_log_fh = None
 
     def set_requires_grad(self, net, requires_grad=False):
         for param in net.parameters():
             param.requires_grad = requires_grad
         return net
 
-    def set_inputs(self, data, fake_images, refined1, refined2):
-        real_first_images, real_second_images, real_images, real_wvs, fake_wvs = data
-
-        real_wvs = real_wvs.view(self.batch_size, -1)
-        fake_wvs = fake_wvs.view(self.batch_size, -1)
-
-        return real_first_images, real_second_images, real_images,\
-               fake_images, refined1, refined2,\
-               real_wvs, fake_wvs
-
     def backward_D(self, real_first_images, fake_images, real_wvs, fake_wvs, update=True, prob_flip_labels=0.0):
 
-        # Real-real
-        pred_rr = self.D(real_first_images, real_wvs)
-        loss_D_rr, self.accuracy_D_rr = self.D_criterionGAN(pred_rr, target_is_real=True, prob_flip_labels=prob_flip_labels)
-        if update:
-            loss_D_rr.backward()
+        with self.autocast():
+            # Real-real
+            pred_rr = self.D(real_first_images, real_wvs)
+            loss_D_rr, self.accuracy_D_rr = self.D_criterionGAN(pred_rr, target_is_real=True, prob_flip_labels=prob_flip_labels)
 
-        ## Fake-real
-        pred_fr = self.D(fake_images.detach(), real_wvs)
-        loss_D_fr, self.accuracy_D_fr = self.D_criterionGAN(pred_fr, target_is_real=False, prob_flip_labels=prob_flip_labels)
-        if update:
-            loss_D_fr.backward()
+            ## Fake-real
+            pred_fr = self.D(fake_images.detach(), real_wvs)
+            loss_D_fr, self.accuracy_D_fr = self.D_criterionGAN(pred_fr, target_is_real=False, prob_flip_labels=prob_flip_labels)
 
-        ## Real-fake
-        # pred_rf = self.D(real_first_images, fake_wvs)
-        # loss_D_rf, self.accuracy_D_rf = self.D_criterionGAN(pred_rf, target_is_real=False, prob_flip_labels=prob_flip_labels)
-        # if update:
-        #     loss_D_rf.backward()
+            ## Real-fake
+            # pred_rf = self.D(real_first_images, fake_wvs)
+            # loss_D_rf, self.accuracy_D_rf = self.D_criterionGAN(pred_rf, target_is_real=False, prob_flip_labels=prob_flip_labels)
 
+        ## Gradient penalty stays in fp32 and eager (double backward)
         if self.gan_loss1 == 'wgangp':
-            self.loss_gp_fr, _, _ = get_paired_gradient_penalty(self.D, (real_first_images, real_wvs), (fake_images, real_wvs), self.device,
+            self.loss_gp_fr, _, _ = get_paired_gradient_penalty(self.uncompiled(self.D), (real_first_images, real_wvs), (fake_images.float(), real_wvs), self.device,
                                                    type='mixed', constant=1.0, lambda_gp=10.0)
             # self.loss_gp_fr, _ = get_single_gradient_penalty(self.D, real_first_images, fake_images, self.device,
             #                                        type='mixed', constant=1.0, lambda_gp=10.0)
             # self.loss_gp_rf, _, _ = get_paired_gradient_penalty(self.D, (real_first_images, real_wvs), (real_first_images, fake_wvs), self.device,
             #                                        type='mixed', constant=1.0, lambda_gp=10.0)
-            if update:
-                self.loss_gp_fr.backward(retain_graph=True)
-                # self.loss_gp_rf.backward(retain_graph=True)
 
             self.loss_D = loss_D_rr + loss_D_fr + self.loss_gp_fr
         else:
             self.loss_D = loss_D_rr + loss_D_fr
 
+        ## Single backward, one gradient all-reduce per step
+        if update:
+            self.loss_D.backward()
+
     def backward_D_decider(self, real_second_images, refined1, update=True, prob_flip_labels=0.0):
 
-        # Real-real
-        pred_rr = self.D_decider(real_second_images)
-        loss_D_decider_rr, self.accuracy_D_decider_rr = self.D_decider_criterionGAN(pred_rr, target_is_real=True, prob_flip_labels=prob_flip_labels)
-        if update:
-            loss_D_decider_rr.backward()
+        with self.autocast():
+            # Real-real
+            pred_rr = self.D_decider(real_second_images)
+            loss_D_decider_rr, self.accuracy_D_decider_rr = self.D_decider_criterionGAN(pred_rr, target_is_real=True, prob_flip_labels=prob_flip_labels)
 
-        ## Fake refined-real
-        pred_refined_fr = self.D_decider(refined1.detach())
-        loss_D_decider_fr, self.accuracy_D_decider_fr = self.D_decider_criterionGAN(pred_refined_fr, target_is_real=False, prob_flip_labels=prob_flip_labels)
-        if update:
-            loss_D_decider_fr.backward()
+            ## Fake refined-real
+            pred_refined_fr = self.D_decider(refined1.detach())
+            loss_D_decider_fr, self.accuracy_D_decider_fr = self.D_decider_criterionGAN(pred_refined_fr, target_is_real=False, prob_flip_labels=prob_flip_labels)
 
+        ## Gradient penalty stays in fp32 and eager (double backward)
         if self.gan_loss2 == 'wgangp':
-            self.loss_gp_decider_fr, _ = get_single_gradient_penalty(self.D_decider, real_second_images, refined1, self.device,
+            self.loss_gp_decider_fr, _ = get_single_gradient_penalty(self.uncompiled(self.D_decider), real_second_images, refined1.float(), self.device,
                                                                      type='mixed', constant=1.0, lambda_gp=10.0)
-            if update:
-                self.loss_gp_decider_fr.backward(retain_graph=True)
 
             self.loss_D_decider = loss_D_decider_rr + loss_D_decider_fr + self.loss_gp_decider_fr
         else:
             self.loss_D_decider = loss_D_decider_rr + loss_D_decider_fr
 
+        if update:
+            self.loss_D_decider.backward()
+
     def backward_D_decider2(self, real_images, refined2, update=True, prob_flip_labels=0.0):
 
-        # Real-real
-        pred_rr = self.D_decider2(real_images)
-        loss_D_decider2_rr, self.accuracy_D_decider2_rr = self.D_decider2_criterionGAN(pred_rr, target_is_real=True, prob_flip_labels=prob_flip_labels)
-        if update:
-            loss_D_decider2_rr.backward()
+        with self.autocast():
+            # Real-real
+            pred_rr = self.D_decider2(real_images)
+            loss_D_decider2_rr, self.accuracy_D_decider2_rr = self.D_decider2_criterionGAN(pred_rr, target_is_real=True, prob_flip_labels=prob_flip_labels)
 
-        ## Fake refined-real
-        pred_refined_fr = self.D_decider2(refined2.detach())
-        loss_D_decider2_fr, self.accuracy_D_decider2_fr = self.D_decider2_criterionGAN(pred_refined_fr, target_is_real=False, prob_flip_labels=prob_flip_labels)
-        if update:
-            loss_D_decider2_fr.backward()
+            ## Fake refined-real
+            pred_refined_fr = self.D_decider2(refined2.detach())
+            loss_D_decider2_fr, self.accuracy_D_decider2_fr = self.D_decider2_criterionGAN(pred_refined_fr, target_is_real=False, prob_flip_labels=prob_flip_labels)
 
+        ## Gradient penalty stays in fp32 and eager (double backward)
         if self.gan_loss2 == 'wgangp':
-            self.loss_gp_decider2_fr, _ = get_single_gradient_penalty(self.D_decider2, real_images, refined2, self.device,
+            self.loss_gp_decider2_fr, _ = get_single_gradient_penalty(self.uncompiled(self.D_decider2), real_images, refined2.float(), self.device,
                                                                       type='mixed', constant=1.0, lambda_gp=10.0)
-            if update:
-                self.loss_gp_decider2_fr.backward(retain_graph=True)
 
             self.loss_D_decider2 = loss_D_decider2_rr + loss_D_decider2_fr + self.loss_gp_decider2_fr
         else:
             self.loss_D_decider2 = loss_D_decider2_rr + loss_D_decider2_fr
 
-    def backward_G(self, real_first_images, fake_images, real_wvs, update=True, prob_flip_labels=0.0):
+        if update:
+            self.loss_D_decider2.backward()
 
-        ## Fake-real
-        pred_fr = self.D(fake_images, real_wvs)
+    def backward_G(self, real_first_images, fake_images, real_wvs, update=True, prob_flip_labels=0.0):
 
-        loss_G_dist = self.G_criterion_dist(fake_images, real_first_images) * self.lambda_l1
-        loss_G_GAN, _ = self.G_criterionGAN(pred_fr, target_is_real=True, prob_flip_labels=prob_flip_labels)
+        ## D is frozen here, its gradients are never synced
+        with self.no_sync(self.D):
+            with self.autocast():
+                ## Fake-real
+                pred_fr = self.D(fake_images, real_wvs)
 
-        if update:
-            loss_G_dist.backward(retain_graph=True)
-            loss_G_GAN.backward(retain_graph=True)
+                loss_G_dist = self.G_criterion_dist(fake_images, real_first_images) * self.lambda_l1
+                loss_G_GAN, _ = self.G_criterionGAN(pred_fr, target_is_real=True, prob_flip_labels=prob_flip_labels)
 
-        self.loss_G = loss_G_dist + loss_G_GAN
+            self.loss_G = loss_G_dist + loss_G_GAN
+            if update:
+                self.loss_G.backward()
 
     def backward_G_refiner(self, real_second_images, refined1, update=True, prob_flip_labels=0.0):
 
-        ## Fake-real
-        pred_refined_fr = self.D_decider(refined1)
+        with self.no_sync(self.D_decider):
+            with self.autocast():
+                ## Fake-real
+                pred_refined_fr = self.D_decider(refined1)
 
-        loss_G_refiner_dist = self.G_refiner_criterion_dist(refined1, real_second_images) * self.lambda_l1
-        loss_G_refiner_GAN, _ = self.G_refiner_criterionGAN(pred_refined_fr, target_is_real=True, prob_flip_labels=prob_flip_labels)
+                loss_G_refiner_dist = self.G_refiner_criterion_dist(refined1, real_second_images) * self.lambda_l1
+                loss_G_refiner_GAN, _ = self.G_refiner_criterionGAN(pred_refined_fr, target_is_real=True, prob_flip_labels=prob_flip_labels)
 
-        if update:
-            loss_G_refiner_dist.backward(retain_graph=True)
-            loss_G_refiner_GAN.backward(retain_graph=True)
-
-        self.loss_G_refiner = loss_G_refiner_dist + loss_G_refiner_GAN
+            self.loss_G_refiner = loss_G_refiner_dist + loss_G_refiner_GAN
+            if update:
+                self.loss_G_refiner.backward()
 
     def backward_G_refiner2(self, real_images, refined2, update=True, prob_flip_labels=0.0):
 
-        ## Fake-real
-        pred_refined_fr = self.D_decider2(refined2)
+        with self.no_sync(self.D_decider2):
+            with self.autocast():
+                ## Fake-real
+                pred_refined_fr = self.D_decider2(refined2)
 
-        loss_G_refiner2_dist = self.G_refiner2_criterion_dist(refined2, real_images) * self.lambda_l1
-        loss_G_refiner2_GAN, _ = self.G_refiner2_criterionGAN(pred_refined_fr, target_is_real=True, prob_flip_labels=prob_flip_labels)
+                loss_G_refiner2_dist = self.G_refiner2_criterion_dist(refined2, real_images) * self.lambda_l1
+                loss_G_refiner2_GAN, _ = self.G_refiner2_criterionGAN(pred_refined_fr, target_is_real=True, prob_flip_labels=prob_flip_labels)
 
-        if update:
-            loss_G_refiner2_dist.backward(retain_graph=True)
-            loss_G_refiner2_GAN.backward(retain_graph=True)
-
-        self.loss_G_refiner2 = loss_G_refiner2_dist + loss_G_refiner2_GAN
-
-    def get_losses(self):
-        loss_g = self.loss_G.item() if self.loss_G else -1.0
-        loss_d = self.loss_D.item() if self.loss_D else -1.0
-        loss_g_refiner = self.loss_G_refiner.item() if self.loss_G_refiner else -1.0
-        loss_d_decider = self.loss_D_decider.item() if self.loss_D_decider else -1.0
-        loss_g_refiner2 = self.loss_G_refiner2.item() if self.loss_G_refiner2 else -1.0
-        loss_d_decider2 = self.loss_D_decider2.item() if self.loss_D_decider2 else -1.0
-        loss_gp_fr = self.loss_gp_fr.item() if self.loss_gp_fr else -1.0
-        loss_gp_rf = self.loss_gp_rf.item() if self.loss_gp_rf else -1.0
-        loss_gp_decider_fr = self.loss_gp_decider_fr.item() if self.loss_gp_decider_fr else -1.0
-        loss_gp_decider2_fr = self.loss_gp_decider2_fr.item() if self.loss_gp_decider2_fr else -1.0
-        return loss_g, loss_d, loss_g_refiner, loss_d_decider, loss_g_refiner2, loss_d_decider2,\
-               loss_gp_fr, loss_gp_rf, loss_gp_decider_fr, loss_gp_decider2_fr
+            self.loss_G_refiner2 = loss_G_refiner2_dist + loss_G_refiner2_GAN
+            if update:
+                self.loss_G_refiner2.backward()
+
+    def get_losses(self, as_tensor=False):
+        ## Stack on device and sync once, -1.0 for losses not computed
+        losses = [self.loss_G, self.loss_D, self.loss_G_refiner, self.loss_D_decider, self.loss_G_refiner2, self.loss_D_decider2,
+                  self.loss_gp_fr, self.loss_gp_rf, self.loss_gp_decider_fr, self.loss_gp_decider2_fr]
+        losses = torch.stack([loss.detach().float().reshape(()) if torch.is_tensor(loss) else self.loss_placeholder for loss in losses])
+        if as_tensor:
+            return losses
+        return tuple(losses.cpu().tolist())
 
     def get_D_accuracy(self):
         return self.accuracy_D_rr, self.accuracy_D_rf, self.accuracy_D_fr,\
                self.accuracy_D_decider_rr, self.accuracy_D_decider_fr, self.accuracy_D_decider2_rr, self.accuracy_D_decider2_fr
 
     def update_lr(self, loss_g, loss_d, loss_g_refiner, loss_d_decider, loss_g_refiner2, loss_d_decider2):
-        self.G_lr_scheduler.step(loss_g)
-        self.D_lr_scheduler.step(loss_d)
-        self.G_refiner_lr_scheduler.step(loss_g_refiner)
-        self.D_decider_lr_scheduler.step(loss_d_decider)
-        self.G_refiner2_lr_scheduler.step(loss_g_refiner2)
-        self.D_decider2_lr_scheduler.step(loss_d_decider2)
-        G_lr = self.G_optimizer.param_groups[0]['lr']
-        D_lr = self.D_optimizer.param_groups[0]['lr']
-        G_refiner_lr = self.G_refiner_optimizer.param_groups[0]['lr']
-        D_decider_lr = self.D_decider_optimizer.param_groups[0]['lr']
-        G_refiner2_lr = self.G_refiner2_optimizer.param_groups[0]['lr']
-        D_decider2_lr = self.D_decider2_optimizer.param_groups[0]['lr']
-
-        print('\t\t(G learning rate is {:.4E})'.format(G_lr))
-        print('\t\t(D learning rate is {:.4E})'.format(D_lr))
-        print('\t\t(G_refiner learning rate is {:.4E})'.format(G_refiner_lr))
-        print('\t\t(D_decider learning rate is {:.4E})'.format(D_decider_lr))
-        print('\t\t(G_refiner2 learning rate is {:.4E})'.format(G_refiner2_lr))
-        print('\t\t(D_decider2 learning rate is {:.4E})'.format(D_decider2_lr))
+        ## Average epoch losses over processes so every scheduler takes the same step
+        if self.distributed:
+            losses = torch.tensor([loss_g, loss_d, loss_g_refiner, loss_d_decider, loss_g_refiner2, loss_d_decider2], device=self.device)
+            dist.all_reduce(losses)
+            loss_g, loss_d, loss_g_refiner, loss_d_decider, loss_g_refiner2, loss_d_decider2 = (losses / dist.get_world_size()).tolist()
+        schedules = [('G', self.G_optimizer, self.G_lr_scheduler, loss_g),
+                     ('D', self.D_optimizer, self.D_lr_scheduler, loss_d),
+                     ('G_refiner', self.G_refiner_optimizer, self.G_refiner_lr_scheduler, loss_g_refiner),
+                     ('D_decider', self.D_decider_optimizer, self.D_decider_lr_scheduler, loss_d_decider),
+                     ('G_refiner2', self.G_refiner2_optimizer, self.G_refiner2_lr_scheduler, loss_g_refiner2),
+                     ('D_decider2', self.D_decider2_optimizer, self.D_decider2_lr_scheduler, loss_d_decider2)]
+        for name, optimizer, lr_scheduler, loss in schedules:
+            lr_scheduler.step(loss)
+            if self.is_main_process:
+                print('\t\t({} learning rate is {:.4E})'.format(name, optimizer.param_groups[0]['lr']))
+
+    def get_words(self, real_wvs, word2vec_model):
+        ## Normalized vocabulary, built once
+        if self.word_matrix is None:
+            word_matrix = torch.from_numpy(word2vec_model.wv.vectors).to(self.device)
+            self.word_matrix = torch.nn.functional.normalize(word_matrix, dim=1)
+
+        ## Most similar word of all word vectors (cosine similarity) in one matmul
+        b, n, d = real_wvs.size()
+        real_wvs = real_wvs.detach().reshape(b * n, d).to(self.device).float()
+        real_wvs = torch.nn.functional.normalize(real_wvs, dim=1)
+        probs, indices = torch.mm(real_wvs, self.word_matrix.t()).max(dim=1)
+        probs = probs.view(b, n).cpu().numpy()
+        indices = indices.view(b, n).cpu().numpy()
+
+        words_list = []
+        for _probs, _indices in zip(probs, indices):
+            _indices = _indices[_probs > self.min_similarity_prob]  ## Eliminate noise words
+            words_list.append([word2vec_model.wv.index2word[i] for i in _indices])
+        return words_list
+
+    def inverse_normalize(self, images):
+        images = images.detach().to(self.device)
+        if self.inv_normalize:
+            images = images * self.std_tensor + self.mean_tensor
+        return images
 
-    def generate_grid(self, real_wvs, fake_images, refined1, refined2, real_images, word2vec_model):
+    def get_word_images(self, words_list):
+        ## Unique words are visualized by converting into image, written into one preallocated buffer
+        word_images = np.empty((len(words_list), self.config.IMAGE_HEIGHT, self.config.IMAGE_WIDTH, 3), dtype=np.uint8)
+        for i, words in enumerate(words_list):
+            word_images[i] = words2image(np.unique(words), self.config)
+        return torch.from_numpy(word_images).permute(0, 3, 1, 2).to(self.device).float()
 
-        images_bag = []
-        for real_wv, fake_image, _refined1, _refined2, real_image in zip(real_wvs, fake_images, refined1, refined2, real_images):
-
-            ## Get words from word vectors
-            words = []
-            for _real_wv in real_wv:
-                _real_wv = np.array(_real_wv)
-                word, prob = word2vec_model.wv.similar_by_vector(_real_wv)[0]
-                if prob > self.min_similarity_prob:  ## Eliminate noise words
-                    words.append(word)
-
-            ## Unique words are visualized by converting into image
-            words = np.unique(words)
-            word_image = words2image(words, self.config)
-
-            ## Inverse normalize
-            if self.inv_normalize:
-                fake_image = self.inverse_normalizer(fake_image)
-                _refined1 = self.inverse_normalizer(_refined1)
-                _refined2 = self.inverse_normalizer(_refined2)
-                real_image = self.inverse_normalizer(real_image)
-
-            ## Go to cpu numpy array
-            fake_image = fake_image.detach().cpu().numpy().transpose(1, 2, 0)
-            fake_image = np.array(self.image_resizer(Image.fromarray((fake_image * 255.).astype(np.uint8)))) / 255.
-            _refined1 = _refined1.detach().cpu().numpy().transpose(1, 2, 0)
-            _refined1 = np.array(self.image_resizer(Image.fromarray((_refined1 * 255.).astype(np.uint8)))) / 255.
-            _refined2 = _refined2.detach().cpu().numpy().transpose(1, 2, 0)
-            real_image = real_image.detach().cpu().numpy().transpose(1, 2, 0)
-
-            images_bag.extend([word_image, fake_image, _refined1, _refined2, real_image])
-
-        images_bag = np.array(images_bag)
-        grid = make_grid(torch.Tensor(images_bag.transpose(0, 3, 1, 2)), nrow=self.config.N_GRID_ROW).permute(1, 2, 0)
-        grid_pil = Image.fromarray(np.array(grid * 255, dtype=np.uint8))
-        return grid_pil
+    def generate_grid(self, real_wvs, fake_images, refined1, refined2, real_images, word2vec_model):
 
-    def generate_grid_simple(self, real_wvs, refined2, word2vec_model):
+        words_list = self.get_words(real_wvs, word2vec_model)
+        word_images = self.get_word_images(words_list)
 
-        images_bag = []
-        for real_wv, _refined2 in zip(real_wvs, refined2):
+        ## Inverse normalize whole batches
+        fake_images = self.inverse_normalize(fake_images)
+        refined1 = self.inverse_normalize(refined1)
+        refined2 = self.inverse_normalize(refined2)
+        real_images = self.inverse_normalize(real_images)
 
-            ## Get words from word vectors
-            words = []
-            for _real_wv in real_wv:
-                _real_wv = np.array(_real_wv)
-                word, prob = word2vec_model.wv.similar_by_vector(_real_wv)[0]
-                if prob > self.min_similarity_prob:  ## Eliminate noise words
-                    words.append(word)
+        ## Resize smaller stages to the final size
+        size = (self.config.IMAGE_HEIGHT, self.config.IMAGE_WIDTH)
+        fake_images = torch.nn.functional.interpolate(fake_images, size=size, mode='nearest')
+        refined1 = torch.nn.functional.interpolate(refined1, size=size, mode='nearest')
 
-            ## Unique words are visualized by converting into image
-            words = np.unique(words)
-            word_image = words2image(words, self.config)
+        ## Interleave [word, fake, refined1, refined2, real] per sample via strided writes, grid on device
+        images = [word_images, fake_images, refined1, refined2, real_images]
+        images_bag = real_images.new_empty((len(images) * real_images.shape[0], *real_images.shape[1:]))
+        for i, image in enumerate(images):
+            images_bag[i::len(images)] = image
+        return make_grid(images_bag, nrow=self.config.N_GRID_ROW)
 
-            ## Inverse normalize
-            if self.inv_normalize:
-                _refined2 = self.inverse_normalizer(_refined2)
+    def generate_grid_simple(self, real_wvs, refined2, word2vec_model):
 
-            ## Go to cpu numpy array
-            _refined2 = _refined2.detach().cpu().numpy().transpose(1, 2, 0)
+        words_list = self.get_words(real_wvs, word2vec_model)
+        word_images = self.get_word_images(words_list)
 
-            images_bag.extend([word_image, _refined2])
+        ## Inverse normalize whole batch
+        refined2 = self.inverse_normalize(refined2)
 
-        images_bag = np.array(images_bag)
-        grid = make_grid(torch.Tensor(images_bag.transpose(0, 3, 1, 2)), nrow=int(self.config.N_GRID_ROW / 5)).permute(1, 2, 0)
-        grid_pil = Image.fromarray(np.array(grid * 255, dtype=np.uint8))
-        return grid_pil
+        ## Interleave [word, refined2] per sample via strided writes, grid on device
+        images_bag = refined2.new_empty((2 * refined2.shape[0], *refined2.shape[1:]))
+        images_bag[0::2] = word_images
+        images_bag[1::2] = refined2
+        return make_grid(images_bag, nrow=int(self.config.N_GRID_ROW / 5))
 
-    def save_img_output(self, img_pil, filename):
+    def save_img_output(self, grid, filename):
         output_dir = os.path.join(self.model_dir, 'output')
         os.makedirs(output_dir, exist_ok=True)
         output_file = os.path.join(output_dir, 'G_img_grid_' + filename)
-        img_pil.save(output_file)
+        save_image(grid, output_file)
 
-    def save_img_test_grid(self, img_pil, filename, verbose=False):
+    def save_img_test_grid(self, grid, filename, verbose=False):
         output_dir = os.path.join(self.output_dir, 'grid')
         os.makedirs(output_dir, exist_ok=True)
         output_file = os.path.join(output_dir, 'G_img_grid_' + filename)
-        img_pil.save(output_file)
+        save_image(grid, output_file)
         if verbose:
             print(output_file, "saved")
 
@@ -745,40 +753,63 @@ class GANModel(BaseModel):
         if verbose:
             print(output_file, "saved")
 
+    def compile(self, net):
+        return torch.compile(net, mode=self.config.COMPILE_MODE, fullgraph=False)
+
+    def uncompiled(self, net):
+        return getattr(net, '_orig_mod', net)
+
+    def no_sync(self, net):
+        return net.no_sync() if self.distributed else contextlib.nullcontext()
+
+    def autocast(self):
+        if not self.use_amp:
+            return contextlib.nullcontext()
+        return torch.autocast(device_type=self.device.type, dtype=torch.bfloat16)
+
+    def to_device(self, x, **kwargs):
+        ## Nets and image batches go channels_last where supported
+        if self.channels_last:
+            return x.to(self.device, memory_format=torch.channels_last, **kwargs)
+        return x.to(self.device, **kwargs)
+
+    def zero_grad(self, optimizer):
+        ## Free gradients instead of zero filling them where supported
+        if self.set_to_none:
+            optimizer.zero_grad(set_to_none=True)
+        else:
+            optimizer.zero_grad()
+
     def forward(self, net, x):
         return net(x)
 
     def fit(self, data, phase='train', train_D=True, train_G=True):
-        ## Data to device
+        ## Data to device (async copies from the pinned loader memory, G input first)
         real_first_images, real_second_images, real_images, real_wvs, fake_wvs = data
-        real_first_images = real_first_images.to(self.device)
-        real_second_images = real_second_images.to(self.device)
-        real_images = real_images.to(self.device)
-        real_wvs = real_wvs.to(self.device)
-        fake_wvs = fake_wvs.to(self.device)
-        data = real_first_images, real_second_images, real_images, real_wvs, fake_wvs
-
-        ## Forward G
-        real_wvs_flat = real_wvs.view(self.batch_size, -1)
-        fake_images = self.forward(self.G, real_wvs_flat)
-
-        ## Forward G_refiner
-        refined1 = self.forward(self.G_refiner, fake_images)
-        
-        ## Forward G_refiner2
-        refined2 = self.forward(self.G_refiner2, refined1)
+        real_wvs = real_wvs.to(self.device, non_blocking=True).view(self.batch_size, -1)
+        fake_wvs = fake_wvs.to(self.device, non_blocking=True).view(self.batch_size, -1)
+        real_first_images = self.to_device(real_first_images, non_blocking=True)
+        real_second_images = self.to_device(real_second_images, non_blocking=True)
+        real_images = self.to_device(real_images, non_blocking=True)
+
+        with self.autocast():
+            ## Forward G
+            fake_images = self.forward(self.G, real_wvs)
+
+            ## Forward G_refiner (each stage is trained by its own losses only,
+            ## so the refiners' backward never has to run through the previous stage)
+            refined1 = self.forward(self.G_refiner, fake_images.detach())
 
-        ## Set inputs
-        real_first_images, real_second_images, real_images, fake_images, refined1, refined2, real_wvs, fake_wvs =\
-            self.set_inputs(data, fake_images, refined1, refined2)
+            ## Forward G_refiner2
+            refined2 = self.forward(self.G_refiner2, refined1.detach())
 
         if phase == 'train':
 
             ## Update D
             self.D = self.set_requires_grad(self.D, train_D)
-            # all_true = np.all([param.requires_grad for param in self.D.parameters()])
+            # all_true = all(param.requires_grad for param in self.D.parameters())
             # print("All D parameters have grad:", str(all_true))
-            self.D_optimizer.zero_grad()
+            self.zero_grad(self.D_optimizer)
             self.backward_D(real_first_images, fake_images, real_wvs, fake_wvs, update=train_D, prob_flip_labels=self.prob_flip_labels)
             if train_D:
                 self.D_optimizer.step()
@@ -786,7 +817,7 @@ class GANModel(BaseModel):
             ## Update G
             self.D = self.set_requires_grad(self.D, False)      # Disable backprop for D
             self.G = self.set_requires_grad(self.G, train_G)
-            self.G_optimizer.zero_grad()
+            self.zero_grad(self.G_optimizer)
             self.backward_G(real_first_images, fake_images, real_wvs, update=train_G, prob_flip_labels=self.prob_flip_labels)
             if train_G:
                 self.G_optimizer.step()
@@ -794,7 +825,7 @@ class GANModel(BaseModel):
 
             ## Update D_decider
             self.D_decider = self.set_requires_grad(self.D_decider, train_D)
-            self.D_decider_optimizer.zero_grad()
+            self.zero_grad(self.D_decider_optimizer)
             self.backward_D_decider(real_second_images, refined1, update=train_D, prob_flip_labels=self.prob_flip_labels)
             if train_D:
                 self.D_decider_optimizer.step()
@@ -802,7 +833,7 @@ class GANModel(BaseModel):
             ## Update G_refiner
             self.D_decider = self.set_requires_grad(self.D_decider, False)      # Disable backprop for D
             self.G_refiner = self.set_requires_grad(self.G_refiner, train_G)
-            self.G_refiner_optimizer.zero_grad()
+            self.zero_grad(self.G_refiner_optimizer)
             self.backward_G_refiner(real_second_images, refined1, update=train_G, prob_flip_labels=self.prob_flip_labels)
             if train_G:
                 self.G_refiner_optimizer.step()
@@ -810,7 +841,7 @@ class GANModel(BaseModel):
 
             ## Update D_decider2
             self.D_decider2 = self.set_requires_grad(self.D_decider2, train_D)
-            self.D_decider2_optimizer.zero_grad()
+            self.zero_grad(self.D_decider2_optimizer)
             self.backward_D_decider2(real_images, refined2, update=train_D, prob_flip_labels=self.prob_flip_labels)
             if train_D:
                 self.D_decider2_optimizer.step()
@@ -818,7 +849,7 @@ class GANModel(BaseModel):
             ## Update G_refiner
             self.D_decider2 = self.set_requires_grad(self.D_decider2, False)      # Disable backprop for D
             self.G_refiner2 = self.set_requires_grad(self.G_refiner2, train_G)
-            self.G_refiner2_optimizer.zero_grad()
+            self.zero_grad(self.G_refiner2_optimizer)
             self.backward_G_refiner2(real_images, refined2, update=train_G, prob_flip_labels=self.prob_flip_labels)
             if train_G:
                 self.G_refiner2_optimizer.step()
@@ -831,4 +862,5 @@ class GANModel(BaseModel):
             self.backward_D_decider2(real_images, refined2, update=False, prob_flip_labels=0.0)
             self.backward_G_refiner2(real_images, refined2, update=False, prob_flip_labels=0.0)
 
-        return fake_images, refined1, refined2
+        ## Outputs are used for visualization, back to fp32
+        return fake_images.float(), refined1.float(), refined2.float()
@@ -4,6 +4,7 @@ import uuid
 
 import numpy as np
 import torch
+import torch.distributed as dist
 import torch.nn as nn
 import torchvision.transforms as transforms
 from PIL import Image, ImageDraw, ImageFont
@@ -100,7 +101,7 @@ def get_single_gradient_penalty(netD, real_image, fake_image, device, type='mixe
         gradients = torch.autograd.grad(outputs=disc_interpolates, inputs=[interpolatesv, ],
                                         grad_outputs=torch.ones(disc_interpolates.size()).to(device),
                                         create_graph=True, retain_graph=True, only_inputs=True)
-        gradients = gradients[0].view(real_image.size(0), -1)
+        gradients = gradients[0].reshape(real_image.size(0), -1)
         gradient_penalty = (((gradients + 1e-16).norm(2, dim=1) - constant) ** 2).mean() * lambda_gp        # added eps
         return gradient_penalty, gradients
     else:
@@ -130,7 +131,7 @@ def get_paired_gradient_penalty(netD, real_data, fake_data, device, type='mixed'
         gradients = torch.autograd.grad(outputs=disc_interpolates, inputs=[interpolatesv, wv],
                                         grad_outputs=torch.ones(disc_interpolates.size()).to(device),
                                         create_graph=True, retain_graph=True, only_inputs=True)
-        gradients0 = gradients[0].view(real_image.size(0), -1)
+        gradients0 = gradients[0].reshape(real_image.size(0), -1)
         gradients1 = gradients[1].view(real_wv.size(0), -1)
         gradient_penalty0 = (((gradients0 + 1e-16).norm(2, dim=1) - constant) ** 2).mean() * lambda_gp        # added eps
         gradient_penalty1 = (((gradients1 + 1e-16).norm(2, dim=1) - constant) ** 2).mean() * lambda_gp        # added eps
@@ -203,6 +204,13 @@ class ImageUtilities(object):
     def image_elastic_deformer(alpha_range, sigma_range):
         return ElasticDeformation(alpha_range, sigma_range)
 
+def init_distributed(config):
+    """ Initialize the process group once per process when launched with torchrun. """
+    if not config.DISTRIBUTED or dist.is_initialized():
+        return
+    torch.cuda.set_device(config.LOCAL_RANK)
+    dist.init_process_group(backend=config.DIST_BACKEND, init_method='env://')
+
 def get_uuid():
     return str(uuid.uuid4()).split('-')[-1]
 
@@ -87,6 +87,8 @@ if __name__ == "__main__":
     ## Import model
     model_dir = os.path.dirname(os.path.abspath(model_file))
     model_lib_dir = os.path.join(model_dir, 'lib')
+    if not os.path.isdir(model_lib_dir):   ## Zipped snapshot, importable from sys.path
+        model_lib_dir = os.path.join(model_dir, 'lib_snapshot.zip', 'lib')
     sys.path.append(model_lib_dir)
     from model import GANModel
 
@@ -154,10 +156,10 @@ if __name__ == "__main__":
         output_grid_filename = "detailed_output.png"
         output_simple_grid_filename = "simple_output.png"
         output_vanilla_filename = "output.png"
-    grid_img_pil = model.generate_grid(wvs_tensor.clone(), fake_images.clone(), refined1.clone(), refined2.clone(), refined2.clone(), word2vec_model)
-    grid_simple_img_pil = model.generate_grid_simple(wvs_tensor.clone(), refined2.clone(), word2vec_model)
+    grid_img = model.generate_grid(wvs_tensor.clone(), fake_images.clone(), refined1.clone(), refined2.clone(), refined2.clone(), word2vec_model)
+    grid_simple_img = model.generate_grid_simple(wvs_tensor.clone(), refined2.clone(), word2vec_model)
     
-    model.save_img_test_grid(grid_img_pil, output_grid_filename, verbose=True)
-    model.save_img_test_grid(grid_simple_img_pil, output_simple_grid_filename, verbose=True)
+    model.save_img_test_grid(grid_img, output_grid_filename, verbose=True)
+    model.save_img_test_grid(grid_simple_img, output_simple_grid_filename, verbose=True)
     model.save_img_test_single(refined2.clone(), output_vanilla_filename, kind='refined2', verbose=True)
 
@@ -25,6 +25,8 @@ if __name__ == "__main__":
     ## Import model from relevant lib 
     model_dir = os.path.dirname(os.path.abspath(model_file))
     model_lib_dir = os.path.join(model_dir, 'lib')
+    if not os.path.isdir(model_lib_dir):   ## Zipped snapshot, importable from sys.path
+        model_lib_dir = os.path.join(model_dir, 'lib_snapshot.zip', 'lib')
     sys.path.append(model_lib_dir)
     from model import GANModel
     from lib.config import Config
@@ -125,16 +127,16 @@ if __name__ == "__main__":
         ## Save grid
         try:
             grid_filename = "{}_{:08}.png".format(model.model_name, iteration)
-            grid_img_pil = model.generate_grid(real_wvs.clone(), fake_images, refined1, refined2.clone(), real_images, val_dataset.word2vec_model)
-            model.save_img_test_grid(grid_img_pil, grid_filename)
+            grid_img = model.generate_grid(real_wvs.clone(), fake_images, refined1, refined2.clone(), real_images, val_dataset.word2vec_model)
+            model.save_img_test_grid(grid_img, grid_filename)
         except Exception as e:
             print('Grid image generation failed.', e, 'Passing.')
 
         ## Save grid simple
         try:
             grid_filename = "{}_{:08}_simple.png".format(model.model_name, iteration)
-            grid_img_pil = model.generate_grid_simple(real_wvs, refined2, val_dataset.word2vec_model)
-            model.save_img_test_grid(grid_img_pil, grid_filename)
+            grid_img = model.generate_grid_simple(real_wvs, refined2, val_dataset.word2vec_model)
+            model.save_img_test_grid(grid_img, grid_filename)
         except Exception as e:
             print('Grid image generation failed.', e, 'Passing.')
 
@@ -14,6 +14,7 @@ import torch
 import torch.nn as nn
 from gensim.models import Word2Vec
 from torch.utils.data import DataLoader
+from torch.utils.data.distributed import DistributedSampler
 
 
 if __name__ == "__main__":
@@ -29,6 +30,8 @@ if __name__ == "__main__":
     if model_file:
         model_dir = os.path.dirname(os.path.abspath(model_file))
         model_lib_dir = os.path.join(model_dir, 'lib')
+        if not os.path.isdir(model_lib_dir):   ## Zipped snapshot, importable from sys.path
+            model_lib_dir = os.path.join(model_dir, 'lib_snapshot.zip', 'lib')
         sys.path.append(model_lib_dir)
         # from config import Config
         # from dataset import AlignCollate, ImageBatchSampler, TextArtDataLoader
@@ -37,8 +40,11 @@ if __name__ == "__main__":
         from lib.model import GANModel
     from lib.config import Config
     from lib.dataset import AlignCollate, ImageBatchSampler, TextArtDataLoader
+    from lib.utils import init_distributed
 
     CONFIG = Config()
+    init_distributed(CONFIG)
+    batch_size = CONFIG.RANK_BATCH_SIZE if CONFIG.DISTRIBUTED else CONFIG.BATCH_SIZE
 
     ## Data loaders
     print("Data loaders initializing..")
@@ -48,28 +54,32 @@ if __name__ == "__main__":
     val_align_collate = AlignCollate(CONFIG, mode='test')
     # train_batch_sampler = ImageBatchSampler(CONFIG, kind='train')
     # val_batch_sampler = ImageBatchSampler(CONFIG, kind='val')
+    train_sampler = DistributedSampler(train_dataset, shuffle=True) if CONFIG.DISTRIBUTED else None
+    val_sampler = DistributedSampler(val_dataset, shuffle=False) if CONFIG.DISTRIBUTED else None
     train_loader = DataLoader(train_dataset,
-                              batch_size=CONFIG.BATCH_SIZE,
-                              shuffle=True,
+                              batch_size=batch_size,
+                              shuffle=(train_sampler is None),
                               num_workers=CONFIG.N_WORKERS,
                               pin_memory=True,
                               collate_fn=train_align_collate,
                             #   sampler=train_batch_sampler,
+                              sampler=train_sampler,
                               drop_last=True,
                               )
     val_loader = DataLoader(val_dataset,
-                            batch_size=CONFIG.BATCH_SIZE,
+                            batch_size=batch_size,
                             shuffle=False,
                             num_workers=CONFIG.N_WORKERS,
                             pin_memory=True,
                             collate_fn=val_align_collate,
                             # sampler=val_batch_sampler,
+                            sampler=val_sampler,
                             drop_last=True,
                             )
     print("\tTrain size:", len(train_dataset))
     print("\tValidation size:", len(val_dataset))
-    n_train_batch = len(train_dataset) // CONFIG.BATCH_SIZE
-    n_val_batch = len(val_dataset) // CONFIG.BATCH_SIZE
+    n_train_batch = len(train_loader)
+    n_val_batch = len(val_loader)
     time.sleep(0.5)
 
     ## Init model with G and D
@@ -80,22 +90,15 @@ if __name__ == "__main__":
     print("\nTraining starting..")
     for epoch in range(model.epoch, model.epoch + CONFIG.N_EPOCHS):
         print("Epoch {}/{}:".format(epoch, model.epoch + CONFIG.N_EPOCHS - 1))
+        if train_sampler is not None:
+            train_sampler.set_epoch(epoch)
 
         for phase in ['train', 'val']:
 
             phase_start = time.time()
             print("\t{} phase:".format(phase.title()))
 
-            total_loss_g = 0.0
-            total_loss_d = 0.0
-            total_loss_g_refiner = 0.0
-            total_loss_d_decider = 0.0
-            total_loss_g_refiner2 = 0.0
-            total_loss_d_decider2 = 0.0
-            total_loss_gp_fr = 0.0
-            total_loss_gp_rf = 0.0
-            total_loss_gp_decider_fr = 0.0
-            total_loss_gp_decider2_fr = 0.0
+            total_losses = torch.zeros(10, device=model.device)   ## Summed on device, synced at epoch end
             total_acc_rr = 0.0
             total_acc_rf = 0.0
             total_acc_fr = 0.0
@@ -142,22 +145,8 @@ if __name__ == "__main__":
                 fake_images, refined1, refined2 = model.fit(data, phase=phase, train_D=train_D, train_G=train_G)
 
                 ## Update total loss
-                loss_g, loss_d, loss_g_refiner, loss_d_decider, loss_g_refiner2, loss_d_decider2,\
-                    loss_gp_fr, loss_gp_rf, loss_gp_decider_fr, loss_gp_decider2_fr = model.get_losses()
-                total_loss_g += loss_g
-                total_loss_d += loss_d
-                total_loss_g_refiner += loss_g_refiner
-                total_loss_d_decider += loss_d_decider
-                total_loss_g_refiner2 += loss_g_refiner2
-                total_loss_d_decider2 += loss_d_decider2
-                if loss_gp_fr:
-                    total_loss_gp_fr += loss_gp_fr
-                if loss_gp_rf:
-                    total_loss_gp_rf += loss_gp_rf
-                if loss_gp_decider_fr:
-                    total_loss_gp_decider_fr += loss_gp_decider_fr
-                if loss_gp_decider2_fr:
-                    total_loss_gp_decider2_fr += loss_gp_decider2_fr
+                losses = model.get_losses(as_tensor=True)
+                total_losses += losses
 
                 ## Get D accuracy
                 acc_rr, acc_rf, acc_fr, acc_decider_rr, acc_decider_fr, acc_decider2_rr, acc_decider2_fr = model.get_D_accuracy()
@@ -169,14 +158,21 @@ if __name__ == "__main__":
                 total_acc_decider2_rr += acc_decider2_rr
                 total_acc_decider2_fr += acc_decider2_fr
 
+                ## Losses come to host only when they are logged or printed
+                save_logs = iteration % CONFIG.N_LOG_BATCH == 0 and model.is_main_process
+                print_logs = i % CONFIG.N_PRINT_BATCH == 0
+                if save_logs or print_logs:
+                    loss_g, loss_d, loss_g_refiner, loss_d_decider, loss_g_refiner2, loss_d_decider2,\
+                        loss_gp_fr, loss_gp_rf, loss_gp_decider_fr, loss_gp_decider2_fr = losses.tolist()
+
                 ## Save logs
-                if iteration % CONFIG.N_LOG_BATCH == 0:
+                if save_logs:
                     log_tuple = phase, epoch, iteration, loss_g, loss_d, loss_g_refiner, loss_d_decider, loss_g_refiner2, loss_d_decider2,\
                                     acc_rr, acc_rf, acc_fr, acc_decider_rr, acc_decider_fr, acc_decider2_rr, acc_decider2_fr
                     model.save_logs(log_tuple)
 
                 # Print logs
-                if i % CONFIG.N_PRINT_BATCH == 0:
+                if print_logs:
                     print("\t\tBatch {: 4}/{: 4}:".format(i, n_batch), end=' ')
                     if CONFIG.GAN_LOSS1 == 'wgangp':
                         print("G loss: {:.4f} | D loss: {:.4f}".format(loss_g, loss_d), end=' ')
@@ -196,24 +192,16 @@ if __name__ == "__main__":
 
                 ## Save visual outputs
                 try:
-                    if iteration % CONFIG.N_SAVE_VISUALS_BATCH == 0 and phase == 'val':
+                    if iteration % CONFIG.N_SAVE_VISUALS_BATCH == 0 and phase == 'val' and model.is_main_process:
                         output_filename = "{}_{:04}_{:08}.png".format(model.model_name, epoch, iteration)
-                        grid_img_pil = model.generate_grid(real_wvs, fake_images, refined1, refined2, real_images, train_dataset.word2vec_model)
-                        model.save_img_output(grid_img_pil, output_filename)
+                        grid_img = model.generate_grid(real_wvs, fake_images, refined1, refined2, real_images, train_dataset.word2vec_model)
+                        model.save_img_output(grid_img, output_filename)
                         # model.save_grad_output(output_filename)
                 except Exception as e:
                     print('Grid image generation failed.', e, 'Passing.')
 
-            total_loss_g /= (i + 1)
-            total_loss_d /= (i + 1)
-            total_loss_g_refiner /= (i + 1)
-            total_loss_d_decider /= (i + 1)
-            total_loss_g_refiner2 /= (i + 1)
-            total_loss_d_decider2 /= (i + 1)
-            total_loss_gp_fr /= (i + 1)
-            total_loss_gp_rf /= (i + 1)
-            total_loss_gp_decider_fr /= (i + 1)
-            total_loss_gp_decider2_fr /= (i + 1)
+            total_loss_g, total_loss_d, total_loss_g_refiner, total_loss_d_decider, total_loss_g_refiner2, total_loss_d_decider2,\
+                total_loss_gp_fr, total_loss_gp_rf, total_loss_gp_decider_fr, total_loss_gp_decider2_fr = (total_losses / (i + 1)).tolist()
             total_acc_rr /= (i + 1)
             total_acc_rf /= (i + 1)
             total_acc_fr /= (i + 1)
@@ -242,6 +230,8 @@ if __name__ == "__main__":
         model.update_lr(total_loss_g, total_loss_d, total_loss_g_refiner, total_loss_d_decider, total_loss_g_refiner2, total_loss_d_decider2)
 
         ## Save model
-        if epoch % CONFIG.N_SAVE_MODEL_EPOCHS == 0:
+        if epoch % CONFIG.N_SAVE_MODEL_EPOCHS == 0 and model.is_main_process:
             model.save_model_dict(epoch, iteration, total_loss_g, total_loss_d,\
                                   total_loss_g_refiner, total_loss_d_decider, total_loss_g_refiner2, total_loss_d_decider2)
+
+    model.close_logs()